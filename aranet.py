@@ -1,18 +1,18 @@
 #!/usr/bin/env venv/bin/python
-import aranet4
-import bleak
 import sys
 import os
-import tzlocal
 import argparse
 import sqlite3
 import configparser
-import http.client
-import urllib
+import csv
 import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from enum import Enum
-from escpos.printer import CupsPrinter
+from functools import cache
+from contextlib import contextmanager
+from collections.abc import Iterable
 
 
 class DisplayMode(Enum):
@@ -34,13 +34,47 @@ class Column(Enum):
     pressure = "pressure"
 
 
+# the label at the start of each displayed row, padded so that the values line up
+LABELS = {column: f"{column.value}:".ljust(15) for column in Column}
+
+# the symbol for a falling, unchanged, or rising value, indexed by the sign of the change plus one
+CHANGE_SYMBOLS = ('↓', '⇵', '↑')
+
+
+# kept as a single constant so every write hits the same entry in sqlite3's statement cache.
+# a record that's already in the history is skipped rather than aborting the rest of the batch
+INSERT_RECORD = "insert or ignore into records(date, co2, temperature, humidity, pressure) values(?,?,?,?,?)"
+
+# per-column queries for ranking() and percentile(), built once from the known columns
+RANKING = {column.value: f"select count(distinct {column.value}) as count from records where {column.value} > ?"
+    for column in Column}
+PERCENTILE = {column.value: f"select count(*) as count from records where {column.value} < ?" for column in Column}
+
+# how long a pushover request can take, in seconds, before it's given up on.
+# notifications are sent one at a time, so a hung request would otherwise hold up every one after it
+PUSHOVER_TIMEOUT = 10
+
+# the values sqlite accepts for the 'journal mode' and 'synchronous' options.
+# sqlite silently ignores anything else, so they're checked before being used
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_MODES = ('off', 'normal', 'full', 'extra')
+
+# a write this large, like the first sync or an import, changes the table enough to be worth re-analyzing
+ANALYZE_THRESHOLD = 1000
+
+
 class Reading:
     """
     A single sensor reading
     """
+    # readings are created in bulk by History.update(), so they skip the per-instance __dict__
+    __slots__ = ('date', 'timestamp', 'co2', 'temperature', 'humidity', 'pressure', 'battery', 'status', 'interval')
+
     def __init__(self, *, date: datetime, co2: float, temperature: float, humidity: float, pressure: float,
         battery: float = None, status = None, interval: int = None):
         self.date = date
+        # unix time of the reading, so age() and comparisons between readings are simple float arithmetic
+        self.timestamp = date.timestamp() if date is not None else None
         self.co2 = co2
         self.temperature = temperature
         self.humidity = humidity
@@ -67,9 +101,7 @@ class Reading:
         """
         Number of seconds since this reading was taken
         """
-        now = datetime.now().astimezone(timezone.utc)
-        delta = now - self.date
-        return round(delta.total_seconds())
+        return round(time.time() - self.timestamp)
 
 
     def show_change(self, prev: float, curr: float) -> str:
@@ -80,11 +112,7 @@ class Reading:
             prev = curr
 
         delta = curr - prev
-        symbol = '⇵'
-        if delta > 0:
-            symbol = '↑'
-        elif delta < 0:
-            symbol = '↓'
+        symbol = CHANGE_SYMBOLS[(delta > 0) - (delta < 0) + 1]
         return f"{symbol} {delta:.01f}"
     
 
@@ -97,7 +125,7 @@ class Reading:
             value = colorize(self.status.name.lower(), value, mode)
 
         value = bold(value, mode)
-        line = f"{column.value}:{' ' * (14 - len(column.value))}{value}{suffix}"
+        line = f"{LABELS[column]}{value}{suffix}"
 
         if previous is not None:
             line += f" {self.show_change(previous.col(column), self.col(column))}"
@@ -137,7 +165,8 @@ class History:
 
 
     def __enter__(self):
-        self.connection = sqlite3.connect(self.config['history']['file'])
+        # transactions are managed explicitly by transaction() rather than by sqlite3's implicit begins
+        self.connection = sqlite3.connect(self.config['history']['file'], isolation_level=None)
         self.connection.row_factory = sqlite3.Row
         self.cursor = self.connection.cursor()
 
@@ -151,10 +180,26 @@ class History:
 
 
     def __exit__(self, ext_type, exc_value, traceback):
+        # lets sqlite refresh the query planner's statistics for any tables that have changed enough to need it
+        self.cursor.execute("pragma optimize")
         self.cursor.close()
         self.connection.close()
 
 
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the enclosed statements as a single write transaction, which is rolled back if any of them fail
+        """
+        self.cursor.execute("begin immediate")
+        try:
+            yield
+        except BaseException:
+            self.cursor.execute("rollback")
+            raise
+        self.cursor.execute("commit")
+
+
     def load_config(self, filename: str, args: argparse.Namespace) -> configparser.ConfigParser:
         """
         Loads config from filename. Any options specified by command line arguments will be overridden
@@ -169,6 +214,8 @@ class History:
             'monitor': 'False',
             'short': 'False',
             'print': 'False',
+            'journal mode': 'wal',
+            'synchronous': 'normal',
         }
 
         config.read(filename)
@@ -179,22 +226,20 @@ class History:
                 config[section] = {}
 
 
-        if args.mac is not None:
-            config['aranet']['mac'] = args.mac
-        if args.file is not None:
-            config['history']['file'] = args.file
-        if args.format is not None:
-            config['history']['date format'] = args.format
-        if args.notify is not None:
-            config['monitor']['notify'] = str(args.notify)
-        if args.update is not None:
-            config['history']['update'] = str(args.update)
-        if args.monitor is not None:
-            config['monitor']['monitor'] = str(args.monitor)
-        if args.short is not None:
-            config['history']['short'] = str(args.short)
-        if args.print is not None:
-            config['printer']['print'] = str(args.print)
+        overrides = [  # (argument, section, key)
+            ('mac', 'aranet', 'mac'),
+            ('file', 'history', 'file'),
+            ('format', 'history', 'date format'),
+            ('notify', 'monitor', 'notify'),
+            ('update', 'history', 'update'),
+            ('monitor', 'monitor', 'monitor'),
+            ('short', 'history', 'short'),
+            ('print', 'printer', 'print'),
+        ]
+        for (argument, section, key) in overrides:
+            value = getattr(args, argument)
+            if value is not None:
+                config[section][key] = str(value)
 
 
         return config
@@ -204,25 +249,23 @@ class History:
         """
         Returns a dictionary containing min, max, and mean values for co2, temperature, humidity, and pressure
         as well as the total number of records.
+        These are read from the running totals in the stats table rather than computed from every record
         """
-        cols = ['co2', 'temperature', 'humidity', 'pressure']
+        cols = [column.value for column in Column]
+
+        self.cursor.execute("select * from stats")
+        row = self.cursor.fetchone()
+        count = row['count']
+
         stats = {
-            'min': "select " + ', '.join([f"min({col}) as {col}" for col in cols]) + " from records;",
-            'max': "select " + ', '.join([f"max({col}) as {col}" for col in cols]) + " from records;",
-            'mean': "select " + ', '.join([f"avg({col}) as {col}" for col in cols]) + " from records;",
-            'count': "select count(*) from records",
+            'min': {col: row[f"{col}_min"] for col in cols},
+            'max': {col: row[f"{col}_max"] for col in cols},
+            'mean': {col: row[f"{col}_sum"] / row[f"{col}_count"] if row[f"{col}_count"] else None for col in cols},
+            'count': count,
         }
-        for stat in stats:
-            self.cursor.execute(stats[stat])
-            row = self.cursor.fetchone()
-            if stat == 'count':
-                stats[stat] = row[0]
-            else:
-                stats[stat] = dict(row)
         return stats
 
 
-
     def latest(self) -> Reading:
         """
         Returns the last recorded reading
@@ -231,7 +274,7 @@ class History:
         row = self.cursor.fetchone()
         if row is not None:
             result = Reading(
-                date = datetime.fromisoformat(row['date']),
+                date = datetime.fromtimestamp(row['date'], tz=timezone.utc),
                 co2 = row['co2'],
                 temperature = row['temperature'],
                 humidity = row['humidity'],
@@ -248,6 +291,17 @@ class History:
         return result
 
 
+    def latest_date(self) -> datetime | None:
+        """
+        Returns the date of the last recorded reading without loading the rest of the row
+        """
+        self.cursor.execute("select max(date) as date from records")
+        row = self.cursor.fetchone()
+        if row['date'] is None:
+            return None
+        return datetime.fromtimestamp(row['date'], tz=timezone.utc)
+
+
     def print_table(self, stats: dict, width: int) -> None:
         """
         Prints a table containing the min, max, mean, and last recorded values for each column.
@@ -286,7 +340,7 @@ class History:
 
         date = self.last_recorded.date
         if date is not None:
-            tz = tzlocal.get_localzone()
+            tz = local_timezone()
             date = date.astimezone(tz).strftime(self.config['history']['date format'])
         else:
             date = 'never'
@@ -311,30 +365,100 @@ class History:
 
     def create(self) -> None:
         """
-        Creates both the sqlite db and the records table if they don't already exist
+        Creates both the sqlite db and the records table if they don't already exist.
+        Tables from older versions, which stored dates as isoformat text, are migrated to unix timestamps
         """
-        self.cursor.execute("""
+        # by default, WAL with synchronous=normal only syncs on checkpoints rather than on every commit.
+        # both can be overridden in the config, e.g. journal mode = memory for one-off imports
+        journal_mode = self.config['history']['journal mode'].lower()
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError(f"journal mode must be one of {', '.join(JOURNAL_MODES)}, not '{journal_mode}'")
+        synchronous = self.config['history']['synchronous'].lower()
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f"synchronous must be one of {', '.join(SYNCHRONOUS_MODES)}, not '{synchronous}'")
+
+        self.cursor.execute(f"pragma journal_mode={journal_mode}")
+        self.cursor.execute(f"pragma synchronous={synchronous}")
+        self.cursor.execute("pragma temp_store=memory")
+
+        self.cursor.execute("select type from pragma_table_info('records') where name = 'date'")
+        column = self.cursor.fetchone()
+        legacy = column is not None and column['type'].lower() == 'text'
+
+        with self.transaction():
+            if legacy:
+                self.cursor.execute("alter table records rename to legacy_records")
+
+            # an integer primary key is an alias for the rowid, so lookups by date don't need a separate index
+            self.cursor.execute("""
 create table if not exists records (
-date text,
+date integer primary key,
 co2 real,
 temperature real,
 humidity real,
-pressure real,
-primary key(date)
+pressure real
 );
                    """)
-        self.connection.commit()
+
+            if legacy:
+                self.cursor.execute("""
+insert or ignore into records
+select cast(strftime('%s', date) as integer), co2, temperature, humidity, pressure from legacy_records;
+                   """)
+                self.cursor.execute("drop table legacy_records")
+
+            # ranking() and percentile() count the records above or below a value,
+            # which is a range scan over an index rather than a scan of the whole table
+            for column in Column:
+                self.cursor.execute(f"create index if not exists records_{column.value} on records({column.value})")
+
+            # stats holds a single row of running totals that's kept up to date by a trigger on records,
+            # so stats() never has to scan the whole table
+            cols = [column.value for column in Column]
+            self.cursor.execute("create table if not exists stats (id integer primary key check (id = 1), count integer, "
+                + ', '.join([f"{col}_count integer, {col}_sum real, {col}_min real, {col}_max real" for col in cols])
+                + ")")
+
+            # the first time around, the totals are computed from any existing records in a single scan.
+            # after that, the trigger keeps them up to date, so the scan is skipped once the row exists
+            self.cursor.execute("select 1 from stats")
+            if self.cursor.fetchone() is None:
+                self.cursor.execute("insert into stats select 1, count(*), "
+                    + ', '.join([f"count({col}), total({col}), min({col}), max({col})" for col in cols])
+                    + " from records")
+
+            # like the aggregate functions, the trigger skips null values. the two-argument min() and max()
+            # return null if either argument is null, so each falls back to whichever side isn't
+            self.cursor.execute("create trigger if not exists update_stats after insert on records begin "
+                + "update stats set count = count + 1, "
+                + ', '.join([f"{col}_count = {col}_count + (new.{col} is not null), "
+                    + f"{col}_sum = {col}_sum + coalesce(new.{col}, 0), "
+                    + f"{col}_min = coalesce(min({col}_min, new.{col}), {col}_min, new.{col}), "
+                    + f"{col}_max = coalesce(max({col}_max, new.{col}), {col}_max, new.{col})" for col in cols])
+                + "; end")
 
 
     def update(self) -> int:
         """
         Connects to the aranet device to request all records since the last recorded reading.
+        If the history is empty, everything on the device is requested unless 'backfill days' limits it.
         Returns the number of new records
         """
+        # the bluetooth stack is slow to import, so it's only loaded when needed
+        import aranet4
+        import bleak
 
-        # we use latest() instead of last_recorded to ensure
+        # we use latest_date() instead of last_recorded to ensure
         # that there are never gaps in the history
-        latest = self.latest().date or datetime.fromtimestamp(0, tz=timezone.utc)
+        latest = self.latest_date()
+        if latest is None:
+            # on the first sync, only the last few days of records can be requested to save transferring
+            # the device's whole log over bluetooth
+            backfill = self.config['history'].getfloat('backfill days')
+            if backfill is not None:
+                latest = datetime.now(tz=timezone.utc) - timedelta(days=backfill)
+            else:
+                latest = datetime.fromtimestamp(0, tz=timezone.utc)
 
         while True:
             try:
@@ -353,46 +477,114 @@ primary key(date)
             except bleak.exc.BleakDeviceNotFoundError:
                 continue
 
-        new_records = []
-        for entry in records.value:
-            # a record isn't always returned with the same time
-            # so (entry.date > latest) may repeat entries
-            if (entry.date - latest).total_seconds() > 60:
-                reading = Reading(
-                        date = entry.date,
-                        co2 = entry.co2,
-                        temperature = entry.temperature * 9/5 + 32,  # convert celsius to fahrenheit
-                        humidity = entry.humidity,
-                        pressure = entry.pressure,
-                    )
-                new_records.append(reading)
+        # a record isn't always returned with the same time
+        # so (entry.date > latest) may repeat entries
+        cutoff = latest + timedelta(seconds=60)
+        new_records = (
+            Reading(
+                date = entry.date,
+                co2 = entry.co2,
+                temperature = entry.temperature * 9/5 + 32,  # convert celsius to fahrenheit
+                humidity = entry.humidity,
+                pressure = entry.pressure,
+            )
+            for entry in records.value if entry.date > cutoff
+        )
+
+        return self.write(new_records)
+
+
+    def insert(self, rows: Iterable[tuple]) -> int:
+        """
+        Inserts (date, co2, temperature, humidity, pressure) rows, skipping any that are already in the history.
+        Returns the number of rows inserted
+        """
+        # rows are streamed straight into a single executemany(), which keeps the whole batch in one transaction
+        with self.transaction():
+            self.cursor.executemany(INSERT_RECORD, rows)
+            count = self.cursor.rowcount
+
+        if count > ANALYZE_THRESHOLD:
+            self.cursor.execute("analyze records")
 
-        self.write(new_records)
-        return len(new_records)
+        return count
 
 
-    def write(self, records: list[Reading]) -> None:
+    def write(self, records: Iterable[Reading]) -> int:
         """
-        Writes records to the sqlite db
+        Writes records to the sqlite db. Returns the number of records written
         """
-        with self.connection:
+        newest = self.last_recorded
+
+        def rows():
+            nonlocal newest
             for reading in records:
-                self.cursor.execute("insert into records(date, co2, temperature, humidity, pressure) values(?,?,?,?,?)", [
-                    reading.date.isoformat(),
+                if newest.date is None or reading.timestamp > newest.timestamp:
+                    newest = reading
+                yield (
+                    int(reading.timestamp),
                     reading.co2,
                     reading.temperature,
                     reading.humidity,
                     reading.pressure,
-                ])
+                )
+
+        count = self.insert(rows())
+
+        # the newest reading we just wrote is the latest in the history, so there's no need to read it back
+        self.last_recorded = newest
+        return count
+
+
+    def import_csv(self, filename: str) -> int:
+        """
+        Bulk loads records from a csv file with date, co2, temperature, humidity, and pressure columns.
+        Dates are parsed with the configured date format and are taken to be in local time unless the format
+        includes an offset. Temperatures are converted to fahrenheit if the header marks them as celsius.
+        Records that are already in the history are skipped. Returns the number of new records
+        """
+        date_format = self.config['history']['date format']
+
+        # exported files are utf-8 (the header has a °C), often with a byte order mark in front of it
+        with open(filename, newline='', encoding='utf-8-sig') as file:
+            reader = csv.reader(file)
+            header = next(reader, None)
+            if header is None:
+                return 0
+            if len(header) != 5:
+                raise ValueError(f"{filename}: expected 5 columns in the header, found {len(header)}")
+            celsius = '°C' in header[2]
+
+            def rows():
+                for row in reader:
+                    # exported files often end with a blank line
+                    if not row:
+                        continue
+                    if len(row) != 5:
+                        raise ValueError(f"{filename}, line {reader.line_num}: expected 5 columns, found {len(row)}")
+
+                    date, co2, temperature, humidity, pressure = row
+                    # dates are written in local time, both by print() and by the aranet app
+                    date = datetime.strptime(date, date_format)
+                    if date.tzinfo is None:
+                        date = date.replace(tzinfo=local_timezone())
+                    temperature = float(temperature)
+                    if celsius:
+                        temperature = temperature * 9/5 + 32
+                    yield int(date.timestamp()), float(co2), temperature, float(humidity), float(pressure)
+
+            # rows are read from the file as they're inserted, so the file has to stay open until they're all in
+            count = self.insert(rows())
+
         self.last_recorded = self.latest()
+        return count
 
 
     def ranking(self, column: str, value: float) -> int:
         """
         Returns the ranking of the value
         """
-        self.cursor.execute(f"select count(distinct {column}) as count from records where {column} > ?",
-            [value])
+        self.cursor.execute(RANKING[column], [value])
         row = self.cursor.fetchone()
         rank = row['count'] + 1
 
@@ -403,11 +595,12 @@ primary key(date)
         """
         Returns which percentile the value falls in
         """
-        self.cursor.execute(f"select count(*) as count from records where {column} < ?", [value])
+        self.cursor.execute(PERCENTILE[column], [value])
         row = self.cursor.fetchone()
         count = row['count'] + 1
 
-        self.cursor.execute(f"select count(*) as total from records")
+        # the running count in stats saves a second pass over the records
+        self.cursor.execute("select count as total from stats")
         row = self.cursor.fetchone()
         total = row['total']
 
@@ -429,14 +622,35 @@ class Monitor:
         self.output = None
         self.config = config
 
+        # options checked on every scan are resolved once up front
+        self.mac = config['aranet']['mac']
+        self.send_notifications = config['monitor'].getboolean('notify')
+        self.update_history = config['history'].getboolean('update')
+        self.send_to_printer = config['printer'].getboolean('print')
+        self.short = config['history'].getboolean('short')
+
+        self.pushover = None  # opened on the first notification and kept alive between them
+        self.credentials = None  # the encoded token and user, set alongside the connection
+        # notifications are sent from a single worker thread so that the https request doesn't block scanning.
+        # one worker also means the pushover connection is never used by two requests at once
+        self.sender = ThreadPoolExecutor(max_workers=1)
+        self.loop = None
+        self.scanned = None  # set by on_scan() whenever there's new output to show
+        self.redraw = False  # set by show_message() when the live output has to be drawn again in full
+
 
     async def start(self) -> None:
         """
         Starts the scanner and updates the displayed age of the current reading
         """
-        first_time = True  # whether we've called update_output() before
+        import aranet4
+
+        rendered = None  # what's currently on screen, so update_output() can redraw only what changed
         output = None
 
+        self.loop = asyncio.get_running_loop()
+        self.scanned = asyncio.Event()
+
         scanner = aranet4.Aranet4Scanner(self.on_scan)
         await scanner.start()
         while True: # Run forever
@@ -447,15 +661,26 @@ class Monitor:
             if self.output is not None:
                 output = self.output
 
+            # anything else written to the terminal moves the cursor,
+            # so only redrawing what changed would leave the output garbled
+            if self.redraw:
+                self.redraw = False
+                rendered = None
+
             if output is not None:
                 age = f"\nage:           {(self.current or self.history.last_recorded).age()}"
                 if self.interval is not None:
                     age += f"/{self.interval}"
 
-                update_output(output + age, first_time=first_time)
-                first_time = False
+                update_output(output + age, previous=rendered)
+                rendered = output + age
 
-            await asyncio.sleep(1)
+            # the age ticks over every second, but a new reading is shown as soon as it arrives
+            try:
+                await asyncio.wait_for(self.scanned.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+            self.scanned.clear()
         await scanner.stop()
 
 
@@ -464,27 +689,55 @@ class Monitor:
         Sends a notification to the user which will disappear after ttl.
         Uses app and user tokens from config 
         """
+        # only needed when notifications are enabled, so they're left out of every other run's startup
+        import http.client
+        import urllib.parse
+
+        if self.pushover is None:
+            # the fields that are the same for every notification only need to be encoded once.
+            # they're encoded first so that missing credentials don't leave a connection without them
+            self.credentials = urllib.parse.urlencode({
+                "token": self.config['pushover']['token'],
+                "user": self.config['pushover']['user'],
+                "html": 1,
+            })
+            self.pushover = http.client.HTTPSConnection("api.pushover.net:443", timeout=PUSHOVER_TIMEOUT)
+
         form = {
-            "token": self.config['pushover']['token'],
-            "user": self.config['pushover']['user'],
             "title": title,
             "message": body,
-            "html": 1,
         }
         if ttl is not None:
             form["ttl"] = ttl
 
-        conn = http.client.HTTPSConnection("api.pushover.net:443")
-        conn.request("POST", "/1/messages.json",
-            urllib.parse.urlencode(form), { "Content-type": "application/x-www-form-urlencoded" })
-        conn.getresponse()
+        payload = self.credentials + '&' + urllib.parse.urlencode(form)
+        headers = { "Content-type": "application/x-www-form-urlencoded" }
+
+        # reusing the connection skips the TLS handshake, but pushover may have closed it since the last
+        # notification. in that case, close our end so that the retry reconnects
+        try:
+            self.pushover.request("POST", "/1/messages.json", payload, headers)
+            response = self.pushover.getresponse()
+        except (ConnectionError, http.client.HTTPException):
+            self.pushover.close()
+            self.pushover.request("POST", "/1/messages.json", payload, headers)
+            response = self.pushover.getresponse()
+
+        # the response has to be read in full before the connection can be used again
+        content = response.read()
+
+        # pushover explains a rejected notification (a bad token, rate limiting, ...) in the response body
+        if response.status != 200:
+            message = content.decode(errors='replace')
+            raise http.client.HTTPException(f"pushover responded {response.status} {response.reason}: {message}")
 
 
-    def maybe_notify(self, body: str) -> None:
+    def maybe_notify(self) -> None:
         """
-        Determine whether to alert the user and, if so, what alerts to send and for how long
+        Determine whether to alert the user and, if so, what alerts to send and for how long.
+        The notification is only rendered once there's something to send
         """
-        if not self.config['monitor'].getboolean('notify'):
+        if not self.send_notifications:
             return
 
         current = self.current
@@ -501,9 +754,13 @@ class Monitor:
             alerts.append('low temperature')
         if current.temperature > 90:
             alerts.append('high temperature')
-        for col in ['co2', 'temperature', 'humidity', 'pressure']:
-            rank = self.history.ranking(col, current[col])
-            if rank == 1:
+        # a reading ranks first when nothing in the history beats it,
+        # so one lookup of the running maximums covers every column
+        highs = self.history.stats()['max']
+        for col in [column.value for column in Column]:
+            if current[col] is None:
+                continue
+            if highs[col] is None or current[col] >= highs[col]:
                 alerts.append(f"new {col} high score")
                 should_expire = False
 
@@ -511,7 +768,28 @@ class Monitor:
             title = '; '.join(alerts)
             if not should_expire:
                 ttl = None
-            self.notify(title, body, ttl=ttl)
+            body = current.display(DisplayMode.notification, previous=previous, history=self.history)
+            sending = self.sender.submit(self.notify, title, body, ttl=ttl)
+            sending.add_done_callback(self.report_notify_error)
+
+
+    def report_notify_error(self, sending) -> None:
+        """
+        Reports a notification that couldn't be sent, since the sender's thread would otherwise swallow the error
+        """
+        if sending.cancelled():
+            return
+        error = sending.exception()
+        if error is not None:
+            self.show_message(f"Unable to send notification: {error!r}", file=sys.stderr)
+
+
+    def show_message(self, message: str, file=None) -> None:
+        """
+        Prints a message below the live output, which is then drawn again in full underneath it
+        """
+        print(f"\n{message}", file=file, flush=True)
+        self.redraw = True
 
 
     def on_scan(self, advertisement) -> None:
@@ -519,7 +797,7 @@ class Monitor:
         Responds to each new reading from the scanner.
         New distinct readings are displayed and (potentially) written to the history
         """
-        if advertisement.device.address != self.config['aranet']['mac']:
+        if advertisement.device.address != self.mac:
             return
 
         if not advertisement.readings:
@@ -542,44 +820,44 @@ class Monitor:
             )
 
         latest = self.history.last_recorded
-        delta = (self.current.date - (latest.date or datetime.fromtimestamp(0, tz=timezone.utc))).total_seconds() 
+        delta = self.current.timestamp - (latest.timestamp or 0)
 
 
         # the reading is (probably) new
         if delta > 60 or self.output is None:
             self.output = self.current.display(DisplayMode.terminal, previous=latest, history=self.history)
+            self.loop.call_soon_threadsafe(self.scanned.set)
 
             # a new distinct reading
             if delta > 60:
-                notif_output = self.current.display(DisplayMode.notification, previous=latest, history=self.history)
-                self.maybe_notify(notif_output)
-
-                print_output = self.current.display(DisplayMode.printer)
-                self.maybe_print(print_output)
+                self.maybe_notify()
+                self.maybe_print()
                     
                 # if we're writing to the history, we have to ensure that there are no gaps
                 # delta > (self.interval + 60) indicates that we've missed at least one reading
-                if self.config['history'].getboolean('update') and  delta < (self.interval + 60):
+                if self.update_history and  delta < (self.interval + 60):
                         self.history.write([self.current])
                 else:
                     self.history.last_recorded = self.current
 
 
-    def maybe_print(self, output: str) -> None:
-        if not self.config['printer'].getboolean('print'):
+    def maybe_print(self) -> None:
+        if not self.send_to_printer:
             return
 
+        from escpos.printer import CupsPrinter
+
         printer = CupsPrinter(self.config['printer']['printer name'],
             profile="default")
 
-        if not (printer.is_usable() or self.config['history'].getboolean('short')):
-            print('printer is not usable')
+        if not (printer.is_usable() or self.short):
+            self.show_message('printer is not usable')
             return
-        if not (printer.is_online() or self.config['history'].getboolean('short')):
-            print('printer is offline')
+        if not (printer.is_online() or self.short):
+            self.show_message('printer is offline')
             return
 
-        printer.text(output)
+        printer.text(self.current.display(DisplayMode.printer))
         printer.cut()
         printer.close()
 
@@ -600,28 +878,33 @@ class RedirectedStdout:
         sys.stdout = self._stdout
 
 
+# the ordinal suffix for each value of n % 100. 11th, 12th, and 13th are the exceptions to the usual endings
+SUFFIXES = tuple(
+    'th' if n // 10 == 1 else {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10, 'th')
+    for n in range(100)
+)
+
+
 def addSuffix(n: int) -> str:
     """
     Adds the suffix used with a given integer.
     """
-    ones = n % 10
-    tens = n % 100 // 10
-    if tens == 1:
-        suffix = 'th'
-    elif ones == 1:
-        suffix = 'st'
-    elif ones == 2:
-        suffix = 'nd'
-    elif ones == 3:
-        suffix = 'rd'
-    else:
-        suffix = 'th'
-    return f"{n:,}{suffix}"
+    return f"{n:,}{SUFFIXES[n % 100]}"
+
+
+@cache
+def local_timezone():
+    """
+    The system's local timezone. It won't change while we're running, so it's only looked up once
+    """
+    import tzlocal
+
+    return tzlocal.get_localzone()
 
 
 def parse_args(argv) -> argparse.Namespace:
     """
-    Parses command line arguments. All arguments without a default exist as config-file options
+    Parses command line arguments. All arguments without a default, other than --import, exist as config-file options
     """
     parser = argparse.ArgumentParser()
     parser.add_argument('--short', action=argparse.BooleanOptionalAction, help='minimal output')
@@ -633,53 +916,110 @@ def parse_args(argv) -> argparse.Namespace:
     parser.add_argument('--notify', action=argparse.BooleanOptionalAction, help='send notifcations when appropriate')
     parser.add_argument('--monitor', action=argparse.BooleanOptionalAction, help='passively scan for updates')
     parser.add_argument('--print', action=argparse.BooleanOptionalAction, help='send readings to a printer')
+    parser.add_argument('--import', metavar='csv_path', dest='import_file', help='add the records from a csv file to the history')
 
     return parser.parse_args(argv)
 
 
-def update_output(text, first_time=False):
+def update_output(text: str, previous: str = None) -> None:
     """
     For any output with a fixed number of lines, replace the previous.
+    Only the lines that differ from the previous output are redrawn
     """
     # https://en.wikipedia.org/wiki/ANSI_escape_code
 
-    lines = len(text.split('\n'))
-    # move cursor up x lines, clear to end of screen
-    codes = f"\033[{lines - 1}A\r\033[0J{text}"
+    if previous is None:
+        output = text
+    else:
+        lines = text.split('\n')
+        previous_lines = previous.split('\n')
+
+        if len(lines) != len(previous_lines):
+            # move cursor up x lines, clear to end of screen
+            output = cursor_up(len(previous_lines) - 1) + f"\r\033[0J{text}"
+        else:
+            # the cursor sits at the end of the last line, which is always redrawn so that it ends up there again
+            output = ''
+            last = len(lines) - 1
+            for i, (line, previous_line) in enumerate(zip(lines, previous_lines)):
+                if line != previous_line or i == last:
+                    # move up to the line, clear it, rewrite it, then move back down
+                    output += cursor_up(last - i) + f"\r\033[2K{line}" + cursor_down(last - i)
+
+    sys.stdout.write(output)
+    sys.stdout.flush()
 
-    output = text if first_time else codes
 
-    print(output, end='')
+def cursor_up(lines: int) -> str:
+    """
+    Escape code to move the cursor up some number of lines. Moving by zero lines is a no-op
+    """
+    return f"\033[{lines}A" if lines > 0 else ''
 
 
-def find_device() -> str | None:
+def cursor_down(lines: int) -> str:
+    """
+    Escape code to move the cursor down some number of lines. Moving by zero lines is a no-op
+    """
+    return f"\033[{lines}B" if lines > 0 else ''
+
+
+def find_device(duration: int = 30, settle: int = 3) -> str | None:
     """
     Starts a scanner to identify nearby aranet devices.
     If exactly one is found, return its address
     """
     print('No MAC address supplied. Scanning for devices...')
 
-    devices = set()
-
-    def store_scan_result(advertisement) -> None:
-        if not advertisement.device:
-            return
-        devices.add(advertisement.device)
-
-    aranet4.client.find_nearby(store_scan_result, duration=30)
+    devices = asyncio.run(scan_for_devices(duration, settle))
 
     print(f"Found {len(devices)} device(s)")
 
-    for device in devices:
-        print(f"name = {device.name} mac = {device.address}")
+    for address, name in devices.items():
+        print(f"name = {name} mac = {address}")
 
     if len(devices) == 1:
-        device = devices.pop()
-        return device.address
+        return next(iter(devices))
 
     return None
 
 
+async def scan_for_devices(duration: int, settle: int) -> dict[str, str]:
+    """
+    Scans for up to duration seconds and returns the address and name of each aranet device found.
+    Once exactly one device has been seen, the scan ends if no others turn up within settle seconds
+    """
+    import aranet4
+
+    devices = {}  # address: name
+    loop = asyncio.get_running_loop()
+    found = asyncio.Event()
+
+    def store_scan_result(advertisement) -> None:
+        if not advertisement.device or advertisement.device.address in devices:
+            return
+        devices[advertisement.device.address] = advertisement.device.name
+        loop.call_soon_threadsafe(found.set)
+
+    scanner = aranet4.Aranet4Scanner(store_scan_result)
+    await scanner.start()
+
+    deadline = loop.time() + duration
+    try:
+        while (remaining := deadline - loop.time()) > 0:
+            single = len(devices) == 1
+            try:
+                await asyncio.wait_for(found.wait(), timeout=min(settle, remaining) if single else remaining)
+            except asyncio.TimeoutError:
+                if single:
+                    break
+            found.clear()
+    finally:
+        await scanner.stop()
+
+    return devices
+
+
 def bold(text: str, mode: DisplayMode) -> str:
     """
     Bolds text for the specified display mode
@@ -693,26 +1033,35 @@ def bold(text: str, mode: DisplayMode) -> str:
     return result
 
 
+# ansi escape codes used by colorize()
+COLORS = {
+    'black': '\x1b[30m',
+    'red': '\x1b[31m',
+    'green': '\x1b[32m',
+    'yellow': '\x1b[33m',
+    'blue': '\x1b[34m',
+    'magenta': '\x1b[35m',
+    'cyan': '\x1b[36m',
+    'white': '\x1b[37m',
+}
+COLOR_RESET = '\x1b[0m'
+
+# names used by the device that don't match a color above
+COLOR_ALIASES = {
+    'amber': 'yellow',
+}
+
+
 def colorize(color: str, text: str, mode: DisplayMode) -> str:
     """
     Colors text for the specified display mode
     """
-    colors = {
-        'black': '\x1b[30m{}\x1b[0m',
-        'red': '\x1b[31m{}\x1b[0m',
-        'green': '\x1b[32m{}\x1b[0m',
-        'yellow': '\x1b[33m{}\x1b[0m',
-        'blue': '\x1b[34m{}\x1b[0m',
-        'magenta': '\x1b[35m{}\x1b[0m',
-        'cyan': '\x1b[36m{}\x1b[0m',
-        'white': '\x1b[37m{}\x1b[0m',
-    }
-    color = color.replace('amber', 'yellow')
-    
+    color = COLOR_ALIASES.get(color, color)
+
     if mode == DisplayMode.notification:
         result = f"<font color='{color}'>{text}</font>"
     elif mode == DisplayMode.terminal:
-        result = colors[color].format(text)
+        result = f"{COLORS[color]}{text}{COLOR_RESET}"
     else:
         result = text
     return result
@@ -742,6 +1091,9 @@ def main():
             else:
                 new_records = history.update()
 
+        if args.import_file is not None:
+            new_records = (new_records or 0) + history.import_csv(args.import_file)
+
         if not (history.config['history'].getboolean('short') and
             history.config['monitor'].getboolean('monitor')):
             history.print(new_records=new_records)
@@ -752,6 +1104,8 @@ def main():
                 asyncio.run(monitor.start())
             except KeyboardInterrupt:
                 print("User interupted.")
+                # notifications that haven't been sent yet are dropped rather than holding up the exit
+                monitor.sender.shutdown(wait=False, cancel_futures=True)
 
 
 if __name__ == '__main__':